@@ -6,18 +6,32 @@ import requests
 import time
 import yaml
 from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from colorama import Fore
-from fnmatch import fnmatch
-from graphlib import CycleError, TopologicalSorter
+from fnmatch import translate
+from functools import lru_cache
+from runfile.cache import lock as cache_lock, shared_cache
 from runfile.code_block import CodeBlock
 from runfile.exceptions import TargetNotFoundError, \
     RunfileFormatError, RunfileNotFoundError
-from runfile.target import Target, TargetResult
-from runfile.util import duration, msg, to_plaintext, MsgType, Error
+from runfile.target import Target, TargetResult, fingerprint
+from runfile.util import duration, msg, output_lock, to_plaintext, \
+    MsgType, Error
+from tempfile import TemporaryDirectory
+
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+# Shared so includes fetched from the same host reuse one connection
+session = requests.Session()
+# Most included Runfiles that are loaded at the same time
+INCLUDE_WORKERS = 8
 
 
 class Runfile():
-    def __init__(self, path, root=False):
+    def __init__(self, path, root=False, content_provider=None):
         self.path = path
         self.header = None
         self.tokens = []
@@ -25,16 +39,23 @@ class Runfile():
         self.start_time = None
         self.results = []
         self.use_containers = False
+        self.allow_loops = False
+        self.jobs = 1
         self.root = root
+        self._includes = None
+        self._content = None
+        # Called instead of fetch_content() to get the Runfile's text
+        self.content_provider = content_provider
+        # Set by update(): embedded includes are checked against their source
+        self.updating = False
+        # Fetched by update(), so includes embedded in it aren't our copies
+        self.fetched = False
 
     def __str__(self):
-        tokens = [str(t) for t in self.tokens]
-        s = ''.join(tokens)
-        s = re.sub(r'\n*$', "\n\n", s, count=1)
-        for _, rf in self.children.items():
-            s += str(rf)
-        s = re.sub(r'\n*$', "\n", s, count=1)
-        return s
+        parts = [''.join(str(t) for t in self.tokens).rstrip('\n'), '\n\n']
+        for rf in self.children.values():
+            parts.append(str(rf))
+        return ''.join(parts).rstrip('\n') + '\n'
 
     def __hash__(self):
         return hash(self.header)
@@ -46,6 +67,7 @@ class Runfile():
     def write_file(self, content):
         with open(self.path, 'w') as f:
             f.write(content)
+        self._content = content
 
     def save(self):
         self.write_file(str(self))
@@ -54,39 +76,67 @@ class Runfile():
         self.tokenize()
 
     def content(self):
+        if self._content is None:
+            fetch = self.content_provider or self.fetch_content
+            self._content = fetch()
+        return self._content
+
+    def fetch_content(self):
         if os.path.exists(self.path):
             return self.read_file()
 
-        if re.search('https?://', self.path):
-            r = requests.get(self.path)
+        if self.path.startswith(('http://', 'https://')):
+            r = session.get(self.path)
             if r.status_code == 200:
                 return r.text
 
         raise RunfileNotFoundError(self.path)
 
+    def fetch_if_changed(self, known=False):
+        # Used by update(). With known, returns None if the source hasn't
+        # changed since it was last fetched, asking the server with the
+        # validators it sent then
+        seen = shared_cache().get('includes', {}).get(self.path, {})
+        etag = last_modified = None
+        if os.path.exists(self.path):
+            content = self.read_file()
+        elif self.path.startswith(('http://', 'https://')):
+            headers = {}
+            if known and seen.get('etag'):
+                headers['If-None-Match'] = seen['etag']
+            if known and seen.get('last_modified'):
+                headers['If-Modified-Since'] = seen['last_modified']
+            r = session.get(self.path, headers=headers)
+            if r.status_code == 304 and headers:
+                return None
+            if r.status_code != 200:
+                raise RunfileNotFoundError(self.path)
+            content = r.text
+            etag = r.headers.get('ETag')
+            last_modified = r.headers.get('Last-Modified')
+        else:
+            raise RunfileNotFoundError(self.path)
+
+        content_hash = fingerprint(content.encode('utf-8'))
+        with cache_lock:
+            shared_cache()['includes'][self.path] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'hash': content_hash
+            }
+        if known and content_hash == seen.get('hash'):
+            return None
+        return content
+
     def tokenize(self):
-        all_tokens = [self.content(), None]
-        for element in [CodeBlock, RunfileHeader, Target]:
-            i = 0
-            while i < len(all_tokens):
-                chunk = all_tokens[i]
-                if not isinstance(chunk, str):
-                    i += 1
-                    continue
-                match = re.search(
-                    element.pattern, chunk, flags=re.MULTILINE | re.DOTALL)
-                if match:
-                    del all_tokens[i]
-                    if match.span()[0] > 0:
-                        all_tokens.insert(i, chunk[:match.span()[0]])
-                        i += 1
-                    all_tokens.insert(
-                        i, element(orig=match.group(), **match.groupdict()))
-                    i += 1
-                    if match.span()[1] < len(chunk):
-                        all_tokens.insert(i, chunk[match.span()[1]:])
-                else:
-                    i += 1
+        all_tokens = []
+        for chunk in scan(self.content(), CODE_TOKENS):
+            if isinstance(chunk, str):
+                # Headers and targets are only recognized outside code blocks
+                all_tokens.extend(scan(chunk, PROSE_TOKENS))
+            else:
+                all_tokens.append(chunk)
+        all_tokens.append(None)
 
         rf = self
         for token in all_tokens:
@@ -103,9 +153,9 @@ class Runfile():
                         if not child:
                             child = include['name']
                         if child not in rf.children:
-                            rf.children[child] = Runfile(child)
+                            rf.children[child] = Runfile(include['path'])
                         rf = rf.children[child]
-                        rf.header = token
+                    rf.header = token
                 else:
                     rf.header = token
             elif rf is self and not rf.header:
@@ -117,6 +167,7 @@ class Runfile():
         self.name_targets()
 
     def parse(self):
+        self._includes = None
         self.targets = {None: Target(None, None)}
         target = self.targets[None]
         target.runfile = self
@@ -131,54 +182,88 @@ class Runfile():
                 target.runfile = self
             elif isinstance(token, CodeBlock):
                 if token.language == 'yaml':
-                    target.config = yaml.load(
-                        token.body, Loader=yaml.SafeLoader)
+                    target.config = yaml.load(token.body, Loader=_YamlLoader)
                 elif token.language == 'dockerfile':
                     target.dockerfile = token.body
                 else:
                     target.blocks.append(token)
 
     def includes(self):
+        if self._includes is not None:
+            return self._includes
         meta_target = self.targets[None]
         if not meta_target.config:
             return OrderedDict()
         include_list = meta_target.config.get('includes', [])
         includes = OrderedDict()
         for include in include_list:
-            keys = list(include)
-            if len(keys) > 1:
+            if len(include) != 1:
                 raise RunfileFormatError(Error.INCLUDE_MULTIPLE_KEYS)
-            key = keys[0]
+            (key, path), = include.items()
             if key in includes:
                 raise RunfileFormatError(Error.DUPLICATE_INCLUDE.format(key))
-            includes[key] = include[key]
+            includes[key] = path
+        self._includes = includes
         return includes
 
     def ensure_includes(self):
         orig_children = self.children
         self.children = OrderedDict()
-        wanted_includes = self.includes()
-
-        for key, value in wanted_includes.items():
-            if key in orig_children and orig_children[key].path == value:
-                self.children[key] = orig_children[key]
-                continue
-
-            self.children[key] = Runfile(value)
-            self.children[key].load()
-            self.children[key].prepend_include_path(
-                {'name': key, 'path': value})
+        includes = self.includes()
+
+        pending = {}
+        for key, path in includes.items():
+            child = orig_children.get(key)
+            if child is not None and child.path != path:
+                child = None
+            if self.updating and self.fetched:
+                child = None  # Embedded by whoever published this Runfile
+            if child is None or self.updating:
+                pending[key] = child
+            self.children[key] = child
+
+        paths = [includes[key] for key in pending]
+        embedded = list(pending.values())
+        # Includes are usually fetched over the network; load them side by
+        # side rather than one round trip after another
+        if len(pending) > 1:
+            workers = min(len(pending), INCLUDE_WORKERS)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                loaded = list(pool.map(self.load_include, paths, embedded))
+        else:
+            loaded = list(map(self.load_include, paths, embedded))
+
+        # An embedded Runfile being updated already sits under its includers
+        include_path = self.header.include_path if self.header else []
+        for key, child in zip(pending, loaded):
+            self.children[key] = child
+            if child is not pending[key]:
+                child.prepend_include_path({'name': key, 'path': child.path})
+                for include in reversed(include_path):
+                    child.prepend_include_path(include)
+
+    def load_include(self, path, embedded=None):
+        # Under update(), an embedded copy is kept if its source is unchanged
+        child = Runfile(path)
+        if self.updating:
+            content = child.fetch_if_changed(known=embedded is not None)
+            if content is None:
+                embedded.updating = True
+                embedded.ensure_includes()
+                return embedded
+            child._content = content
+            child.updating = child.fetched = True
+        child.load()
+        return child
 
     def child_name(self, path):
-        if not self.includes():
-            return None
         for key, value in self.includes().items():
             if value == path:
                 return key
 
     def name_targets(self, all_targets=None):
         if all_targets is None:
-            all_targets = []
+            all_targets = set()
         for _, target in self.targets.items():
             include_path = target.runfile.header.include_path
             if target.name is None and include_path:
@@ -196,16 +281,17 @@ class Runfile():
                 else:
                     break
             target.unique_name = name
-            all_targets.append(target.unique_name)
+            all_targets.add(target.unique_name)
         for child in self.children:
             self.children[child].name_targets(all_targets)
 
     def find_target(self, target_expr):
         targets = []
+        target_re = glob_to_regex(target_expr)
         for target_name, target in self.targets.items():
             if not target_name:
                 continue
-            if fnmatch(target_name, target_expr):
+            if target_re.match(target_name):
                 targets.append(target)
         if targets and '**' not in target_expr:
             return targets
@@ -216,7 +302,7 @@ class Runfile():
                 return self.children[child_name].find_target(target_expr)
 
         for _, child in self.children.items():
-            targets += child.find_target(target_expr)
+            targets.extend(child.find_target(target_expr))
 
         return targets
 
@@ -228,29 +314,33 @@ class Runfile():
             self.start_time = time.time()
 
         graph = {}
+        found = {}
         for target in self.find_target(target_expr):
-            graph.update(self.graph_dependencies(target))
-            if target not in graph:
-                graph[target] = set()
-            graph[target].add(target.runfile.targets[None])
-
-        ts = TopologicalSorter(graph)
-        cycle_error = None
-        try:
-            for target in ts.static_order():
-                result = target.execute()
-                if result:
-                    result.print_status()
-                    print()
-                self.results.append(result)
-                result.raise_if_failed()
-        except CycleError as e:
-            cycle_error = e
-
-        if cycle_error:
-            targets = [t.name for t in cycle_error.args[1]]
-            raise RunfileFormatError(
-                Error.TARGET_LOOP.format(' -> '.join(targets)))
+            graph.update(self.graph_dependencies(target, found=found))
+            graph.setdefault(target, set())
+        # Every target runs after its own Runfile's global target, which
+        # also starts the container the others run in
+        nodes = set(graph).union(*graph.values())
+        for node in nodes:
+            if node.name:
+                graph.setdefault(node, set()).add(node.runfile.targets[None])
+
+        order, loops = topological_sort(graph)
+        for loop in loops:
+            targets = ' -> '.join(t.name for t in loop)
+            if not self.allow_loops:
+                raise RunfileFormatError(Error.TARGET_LOOP.format(targets))
+            msg(Error.TARGET_LOOP.format(targets), MsgType.WARNING)
+            print()
+
+        with TemporaryDirectory() as rundir:
+            if self.jobs > 1:
+                self.execute_concurrently(order, graph, rundir)
+            else:
+                for target in order:
+                    result = target.execute(rundir=rundir)
+                    self.record(result)
+                    result.raise_if_failed()
 
         self.stop_containers()
         if self.results:
@@ -258,6 +348,51 @@ class Runfile():
         else:
             raise TargetNotFoundError(target=target_expr)
 
+    def execute_concurrently(self, order, graph, rundir):
+        position = {target: i for i, target in enumerate(order)}
+        waiting = {}
+        dependents = {target: [] for target in order}
+        for target in order:
+            # Edges dropped to break loops are the ones pointing forward
+            waiting[target] = {dep for dep in graph.get(target, ())
+                               if position[dep] < position[target]}
+            for dep in waiting[target]:
+                dependents[dep].append(target)
+
+        ready = [target for target in order if not waiting[target]]
+        running = {}
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while ready or running:
+                for target in ready:
+                    future = pool.submit(target.execute, rundir=rundir)
+                    running[future] = target
+                ready = []
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    target = running.pop(future)
+                    result = future.result()
+                    self.record(result)
+                    if result.status == TargetResult.FAILURE:
+                        failure = failure or result
+                    if failure:
+                        ready = []  # Let running targets finish, start no more
+                        continue
+                    for dependent in dependents[target]:
+                        waiting[dependent].discard(target)
+                        if not waiting[dependent]:
+                            ready.append(dependent)
+
+        if failure:
+            failure.raise_if_failed()
+
+    def record(self, result):
+        if result:
+            with output_lock:
+                result.print_status()
+                print()
+        self.results.append(result)
+
     def list_targets(self):
         for target in self.targets.values():
             yield target
@@ -265,38 +400,44 @@ class Runfile():
             for target in child.list_targets():
                 yield target
 
-    def graph_dependencies(self, target, graph=None):
+    def graph_dependencies(self, target, graph=None, found=None):
         if not graph:
             graph = {}
+        if found is None:
+            found = {}
         if target in graph or 'requires' not in target.config:
             return graph
 
         for subtarget_name in target.config['requires']:
-            subtargets = self.find_target(subtarget_name)
-            for subtarget in subtargets:
+            # The same expressions recur across a dependency tree
+            key = (id(self), subtarget_name)
+            if key not in found:
+                found[key] = self.find_target(subtarget_name)
+            for subtarget in found[key]:
                 if target not in graph:
                     graph[target] = set()
                 graph[target].add(subtarget)
                 dependencies = target.runfile.graph_dependencies(
-                    subtarget, graph)
+                    subtarget, graph, found)
                 graph.update(dependencies)
 
         return graph
 
     def prepend_include_path(self, include):
-        self.header.include_path.insert(0, include)
+        self.header.prepend_include(include)
         for child in self.children:
             self.children[child].prepend_include_path(include)
 
     def update(self):
-        self.children = OrderedDict()
+        self.updating = True
+        self._includes = None
         self.ensure_includes()
         self.name_targets()
 
     def print_summary(self):
         if not self.results:
             return  # Nothing happened
-        if self.results[-1].status != TargetResult.FAILURE:
+        if all(r.status != TargetResult.FAILURE for r in self.results):
             status = f'{Fore.GREEN}SUCCESS{Fore.RESET}'
         else:
             status = f'{Fore.RED}FAILURE{Fore.RESET}'
@@ -320,6 +461,9 @@ class RunfileHeader():
     pattern = (r'^#\s+(?P<name>.+?)$'
                r'(?:\n+>\s+(?P<includes>[^#\n].+?))?$'
                r'(?:\n+(?P<desc>[^\#\n].+?))?\n(?=\n|`|#|$)')
+    link_pattern = re.compile(r'\[(?P<name>.+?)\]\((?P<path>.+?)\)')
+    __slots__ = ('orig', 'name', 'orig_desc', 'desc', 'include_path',
+                 '_hash')
 
     def __init__(self, orig=None, name=None, desc=None, includes=None):
         self.orig = orig
@@ -327,9 +471,9 @@ class RunfileHeader():
         self.orig_desc = desc
         self.desc = to_plaintext(desc)
         self.include_path = []
+        self._hash = None
         if includes:
-            pattern = re.compile(r'\[(?P<name>.+?)\]\((?P<path>.+?)\)')
-            for match in pattern.finditer(includes):
+            for match in self.link_pattern.finditer(includes):
                 self.include_path.append(match.groupdict())
 
     def __str__(self):
@@ -355,4 +499,88 @@ class RunfileHeader():
         return True
 
     def __hash__(self):
-        return hash('|'.join([i['path'] for i in self.include_path]))
+        # Targets hash through their Runfile's header while graphing
+        if self._hash is None:
+            self._hash = hash('|'.join(i['path'] for i in self.include_path))
+        return self._hash
+
+    def prepend_include(self, include):
+        self.include_path.insert(0, include)
+        self._hash = None
+
+
+# Orders nodes after the nodes they map to, skipping the edge that closes
+# each loop; the loops found are returned as well
+def topological_sort(graph):
+    order = []
+    loops = []
+    done = {}  # False while a node is on the current path
+    for root in graph:
+        if root in done:
+            continue
+        done[root] = False
+        path = [root]
+        stack = [iter(graph[root])]
+        while stack:
+            for node in stack[-1]:
+                if node not in done:
+                    done[node] = False
+                    path.append(node)
+                    stack.append(iter(graph.get(node, ())))
+                    break
+                if not done[node]:
+                    loops.append(path[path.index(node):] + [node])
+            else:
+                stack.pop()
+                node = path.pop()
+                done[node] = True
+                order.append(node)
+    return order, loops
+
+
+@lru_cache(maxsize=256)
+def glob_to_regex(expr):
+    return re.compile(translate(expr))
+
+
+def token_regex(*elements):
+    alternatives = []
+    for element in elements:
+        kind = element.__name__
+        # Prefix each element's groups so names don't collide in the union
+        pattern = re.sub(r'\(\?P<(\w+)>', f'(?P<{kind}_\\1>', element.pattern)
+        alternatives.append(f'(?P<{kind}>{pattern})')
+    return re.compile('|'.join(alternatives), re.MULTILINE | re.DOTALL)
+
+
+# Each element's (keyword, group name) pairs, so scan needn't sort them out
+def token_groups(regex):
+    groups = {kind: [] for kind in TOKEN_ELEMENTS}
+    for group in regex.groupindex:
+        kind, _, name = group.partition('_')
+        if name:
+            groups[kind].append((name, group))
+    return groups
+
+
+def scan(text, regex):
+    tokens = []
+    last_end = 0
+    groups = TOKEN_GROUPS[regex]
+    for match in regex.finditer(text):
+        if match.start() > last_end:
+            tokens.append(text[last_end:match.start()])
+        kind = match.lastgroup
+        kwargs = {name: match[group] for name, group in groups[kind]}
+        tokens.append(TOKEN_ELEMENTS[kind](orig=match[0], **kwargs))
+        last_end = match.end()
+    if last_end < len(text):
+        tokens.append(text[last_end:])
+    return tokens
+
+
+TOKEN_ELEMENTS = {e.__name__: e for e in (CodeBlock, RunfileHeader, Target)}
+CODE_TOKENS = token_regex(CodeBlock)
+PROSE_TOKENS = token_regex(RunfileHeader, Target)
+TOKEN_GROUPS = {regex: token_groups(regex)
+                for regex in (CODE_TOKENS, PROSE_TOKENS)}
@@ -1,8 +1,71 @@
 #!/usr/bin/env python3
+import fcntl
 import os
+import threading
 import yaml
 from collections.abc import MutableMapping
 
+# The cache is read on every run and rewritten on every update; use libyaml
+# when PyYAML was built with it
+try:
+    from yaml import CSafeDumper as _YamlDumper, CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeDumper as _YamlDumper, SafeLoader as _YamlLoader
+
+CACHE_FILE = '.runcache'
+LOCK_FILE = '.runcache.lock'
+# Bump when target keys or hashes change so stale entries are dropped
+CACHE_VERSION = 2
+
+
+class CacheLock():
+    # Every write rewrites the whole file, so hold this from loading the cache
+    # to syncing it. The thread lock keeps out concurrently running targets;
+    # flock keeps out other processes, e.g. run_set called from a code block
+
+    def __init__(self):
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if not self.depth:
+            self.file = open(LOCK_FILE, 'a')
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if not self.depth:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
+
+lock = CacheLock()
+
+shared = None
+
+
+def file_stamp():
+    try:
+        st = os.stat(CACHE_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+# Reloaded only when someone else changed the file, e.g. run_set in a block
+def shared_cache():
+    global shared
+    with lock:
+        if shared is None or shared.stamp != file_stamp():
+            shared = RunfileCache()
+        return shared
+
 
 def to_cache(cache, d):
     for key in d:
@@ -29,22 +92,49 @@ class RunfileCache(MutableMapping):
         else:
             self.container = container
 
+        # Only the top level is checked against the file. Stat before reading
+        # so a change made in between still triggers a reload
+        self.stamp = file_stamp() if self.container is self else None
         if data:
             self.data = data
-        elif os.path.exists('.runcache') and self.container is self:
-            with open('.runcache', 'r') as f:
-                d = yaml.load(f, Loader=yaml.SafeLoader)
+        elif self.stamp is not None:
+            with open(CACHE_FILE, 'r') as f:
+                d = yaml.load(f, Loader=_YamlLoader) or {}
+                if d.get('version') != CACHE_VERSION:
+                    d.pop('targets', None)
+                    d['version'] = CACHE_VERSION
                 self.data = to_cache(self, d)
         else:
             self.data = {}
 
     def sync(self):
         if self.container is self:
-            with open('.runcache', 'w') as f:
-                yaml.dump(to_dict(self.data), f)
+            # Stamp every write, including the first one, so the next load
+            # doesn't mistake this cache for an old one
+            self.data['version'] = CACHE_VERSION
+            # Replace the file in one step so readers never see it half written
+            tmp_file = f'{CACHE_FILE}.{os.getpid()}.{threading.get_ident()}'
+            with open(tmp_file, 'w') as f:
+                yaml.dump(to_dict(self.data), f, Dumper=_YamlDumper)
+            os.replace(tmp_file, CACHE_FILE)
+            self.stamp = file_stamp()
         else:
             self.container.sync()
 
+    # Delete whichever of items are present, writing the file once
+    def discard(self, items):
+        removed = False
+        for item in items:
+            if item in self.data:
+                del self.data[item]
+                removed = True
+        if removed:
+            self.sync()
+
+    def get(self, item, default=None):
+        # Unlike [], never adds an empty entry that the next sync would save
+        return self.data.get(item, default)
+
     def __getitem__(self, item):
         if item not in self.data:
             self.data[item] = RunfileCache(self.container)
@@ -71,4 +161,4 @@ class RunfileCache(MutableMapping):
         return repr(self.data)
 
     def __str__(self):
-        return yaml.dump(to_dict(self.data))
+        return yaml.dump(to_dict(self.data), Dumper=_YamlDumper)
@@ -30,6 +30,12 @@ def main():
     parser.add_argument(
         '--no-cache', dest='no_cache', action='store_true',
         help='Run all targets, even if they are cached')
+    parser.add_argument(
+        '--allow-loops', dest='allow_loops', action='store_true',
+        help='Warn about dependency loops instead of failing')
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs', type=int, default=1,
+        help='Run up to this many independent targets at once, defaults to 1')
     args = parser.parse_args()
 
     if args.bash_completion:
@@ -80,6 +86,9 @@ def main():
 
     if args.containers:
         rf.use_containers = True
+    if args.allow_loops:
+        rf.allow_loops = True
+    rf.jobs = args.jobs
 
     try:
         rf.execute_target(args.target)
@@ -88,5 +97,8 @@ def main():
         sys.exit(1)
     except TargetExecutionError as e:
         sys.exit(e.exit_code)
+    except RunfileFormatError as e:
+        print(f'RunfileFormatError: {str(e)}', file=sys.stderr)
+        sys.exit(1)
     finally:
         rf.print_summary()
@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 
-import docker
 import os
 import subprocess
 import sys
-from runfile.cache import RunfileCache
+import threading
+from runfile.cache import file_stamp, shared_cache
 from runfile.exceptions import CodeBlockExecutionError
+from runfile.util import docker_client, output_lock
 from subprocess import Popen, PIPE, STDOUT
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkdtemp
 
 language_info = {
     'sh': {
@@ -50,12 +51,52 @@ language_info = {
 }
 
 
+def language_defaults(language, exe=None, file='run',
+                      cmd='/usr/bin/env {exe} "{file}"'):
+    if exe is None:
+        exe = language
+    if not isinstance(exe, list):
+        exe = [exe]
+    return {'exe': exe, 'file': file, 'cmd': cmd}
+
+
+# Resolve defaults once instead of on every block execution
+language_info = {language: language_defaults(language, **info)
+                 for language, info in language_info.items()}
+
+
+# Languages whose blocks can be merged into one script, each in a subshell
+SHELLS = ('sh', 'bash', 'zsh')
+
+
+# Merge runs of same-shell blocks so a container needs one exec for them
+def batch_blocks(blocks):
+    groups = []
+    for block in blocks:
+        if (groups and block.language in SHELLS
+                and groups[-1][0].language == block.language):
+            groups[-1].append(block)
+        else:
+            groups.append([block])
+
+    batched = []
+    for group in groups:
+        if len(group) == 1:
+            batched.append(group[0])
+        else:
+            body = '\n'.join(f'(\n{block.body}\n)' for block in group)
+            batched.append(CodeBlock(language=group[0].language, body=body))
+    return batched
+
+
 class CodeBlock():
     pattern = r'^```(?P<language>.+?)\s?\n(?P<body>.+?)\n```$'
+    __slots__ = ('orig', 'language', 'body')
 
     def __init__(self, orig=None, language=None, body=None):
         self.orig = orig
-        self.language = language
+        # Blocks share a handful of languages; keep one copy of each name
+        self.language = sys.intern(language) if language else language
         self.body = body
 
     def __str__(self):
@@ -73,82 +114,87 @@ class CodeBlock():
             return False
         return True
 
-    def execute(self, container=None):
-        cache = RunfileCache()
-        for key, value in cache['vars'].items():
-            os.environ[key] = value
-        with TemporaryDirectory() as directory:
-            filename = language_info.get(self.language, {}).get('file', 'run')
-            filepath = os.path.join(directory, filename)
-            with open(filepath, 'w') as f:
-                f.write(self.body)
-                f.flush()
-
-            if container:
-                directory = os.path.join('/host', directory[1:])
-                filepath = os.path.join('/host', filepath[1:])
-
-            executables = language_info.get(self.language, {}).get(
-                'exe', self.language)
-            if not isinstance(executables, list):
-                executables = [executables]
-            executable = self.find_executable(executables, container)
-
-            if not executable:
-                raise CodeBlockExecutionError(
-                    f'No executable was found for language "{self.language}".')
-
-            cmd = language_info.get(self.language, {}).get(
-                'cmd',
-                '/usr/bin/env {exe} "{file}"')
-            fmtcmd = cmd.format(
-                dir=directory,
-                file=filepath,
-                exe=executable)
-
-            if container:
-                exit_code = self.execute_in_container(fmtcmd, container)
-            else:
-                exit_code = self.execute_in_subprocess(fmtcmd)
-
-            if exit_code:
-                raise CodeBlockExecutionError(exit_code)
-
-    def execute_in_subprocess(self, cmd):
+    def execute(self, container=None, rundir=None):
+        if rundir is None:
+            with TemporaryDirectory() as directory:
+                return self.execute_in_directory(directory, container)
+        # Each block still gets its own directory; the run directory is
+        # cleaned up once when the whole run finishes
+        return self.execute_in_directory(mkdtemp(dir=rundir), container)
+
+    def execute_in_directory(self, directory, container=None):
+        info = language_info.get(self.language)
+        if info is None:
+            info = language_defaults(self.language)
+
+        filepath = os.path.join(directory, info['file'])
+        with open(filepath, 'w') as f:
+            f.write(self.body)
+            f.flush()
+
+        if container:
+            directory = os.path.join('/host', directory[1:])
+            filepath = os.path.join('/host', filepath[1:])
+
+        executable = self.find_executable(info['exe'], container)
+
+        if not executable:
+            raise CodeBlockExecutionError(
+                f'No executable was found for language "{self.language}".')
+
+        fmtcmd = info['cmd'].format(
+            dir=directory,
+            file=filepath,
+            exe=executable)
+
+        if container:
+            exit_code = self.execute_in_container(fmtcmd, container)
+        else:
+            exit_code = self.execute_in_subprocess(
+                fmtcmd, environment.get())
+
+        if exit_code:
+            raise CodeBlockExecutionError(exit_code)
+
+    def execute_in_subprocess(self, cmd, env=None):
         trailing_byte = b''
-        exit_code = None
-        with Popen(['/bin/sh', '-c', cmd], stdout=PIPE, stderr=STDOUT) as proc:
+        with Popen(['/bin/sh', '-c', cmd], stdout=PIPE, stderr=STDOUT,
+                   env=env) as proc:
+            fd = proc.stdout.fileno()
             while True:
-                exit_code = proc.poll()
-                if exit_code is not None:
-                    read_bytes = proc.stdout.read()
-                else:
-                    read_bytes = proc.stdout.read(1)
-                if read_bytes:
-                    trailing_byte = read_bytes[-1:]
-                sys.stdout.buffer.write(read_bytes)
-                sys.stdout.buffer.flush()
-                if exit_code is not None:
+                # Returns whatever is available, up to the limit
+                read_bytes = os.read(fd, 65536)
+                if not read_bytes:
                     break
+                trailing_byte = read_bytes[-1:]
+                with output_lock:
+                    sys.stdout.buffer.write(read_bytes)
+                    sys.stdout.buffer.flush()
+            exit_code = proc.wait()
 
         if trailing_byte != b"\n":
-            print()
+            with output_lock:
+                print()
 
         return exit_code
 
     def execute_in_container(self, cmd, container):
-        client = docker.from_env()
+        client = docker_client()
         resp = client.api.exec_create(container.id, cmd)
         exec_result = client.api.exec_start(resp['Id'], stream=True)
 
         trailing_byte = b''
         for output in exec_result:
             trailing_byte = output[-1:]
-            sys.stdout.buffer.write(output)
+            # stdout is already buffered; only push it out at line ends
+            with output_lock:
+                sys.stdout.buffer.write(output)
+                if b'\n' in output:
+                    sys.stdout.buffer.flush()
+        with output_lock:
             sys.stdout.buffer.flush()
-
-        if trailing_byte != b"\n":
-            print()
+            if trailing_byte != b"\n":
+                print()
 
         inspect = client.api.exec_inspect(resp['Id'])
         return inspect['ExitCode']
@@ -167,3 +213,26 @@ class CodeBlock():
                     stderr=subprocess.DEVNULL)
                 if proc.returncode == 0:
                     return executable
+
+
+# os.environ plus run_set variables, re-read only when the cache file changes
+class Environment():
+    def __init__(self):
+        self.stamp = None
+        self.env = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            return self.refresh()
+
+    def refresh(self):
+        stamp = file_stamp()
+        if self.env is None or stamp != self.stamp:
+            self.env = dict(os.environ)
+            self.env.update(shared_cache().get('vars', {}))
+            self.stamp = stamp
+        return self.env
+
+
+environment = Environment()
@@ -2,13 +2,15 @@
 
 __runfile_completion () {
     case "${COMP_WORDS[COMP_CWORD]}" in
-        -*) suggestions="-l -u -h -f"
+        -*) suggestions="-l -u -h -f -j"
             suggestions="$suggestions --bash-completion"
             suggestions="$suggestions --containers"
             suggestions="$suggestions --list-targets"
             suggestions="$suggestions --update"
             suggestions="$suggestions --file"
             suggestions="$suggestions --no-cache"
+            suggestions="$suggestions --allow-loops"
+            suggestions="$suggestions --jobs"
             ;;
         *)
             filename='Runfile.md'
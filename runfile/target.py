@@ -1,21 +1,53 @@
 #!/usr/bin/env python3
 
-import docker
 import hashlib
 import os
 import re
 import time
-from runfile.util import duration, human_time_to_seconds, msg, MsgType, \
-    to_plaintext
+from runfile.util import docker_client, duration, human_time_to_seconds, \
+    msg, MsgType, to_plaintext
 from runfile.exceptions import CodeBlockExecutionError, TargetExecutionError, \
     RunfileFormatError, ContainerBuildError
-from runfile.cache import RunfileCache
+from runfile.cache import lock as cache_lock, shared_cache
+from runfile.code_block import batch_blocks
 from io import BytesIO
 
+# Fixed for the life of the process. The working directory is not cached
+# here: the CLI changes into the Runfile's directory after import.
+HOST_UID = os.getuid()
+HOST_GID = os.getgid()
+
+# Parser directives look like comments but change how the file is read
+DIRECTIVE = re.compile(r'#\s*(?:syntax|escape|check)\s*=', re.IGNORECASE)
+
+
+def fingerprint(data):
+    # Only used to spot changed content, not for security
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+# Drop what can't change the built image: blank lines, comments and trailing
+# whitespace
+def normalize_dockerfile(dockerfile):
+    if '<<' in dockerfile:  # Heredoc bodies may depend on them
+        return dockerfile
+    lines = []
+    for line in dockerfile.splitlines():
+        line = line.rstrip()
+        stripped = line.lstrip()
+        if not stripped:
+            continue
+        if stripped.startswith('#') and not DIRECTIVE.match(stripped):
+            continue
+        lines.append(line)
+    return '\n'.join(lines)
+
 
 class Target():
     pattern = (r'^\#\#\s+(?P<name>.+?)'
                r'(?:\n+(?P<desc>[^\#\n].+?))?\n(?=\n|`|#|$)')
+    name_pattern = re.compile(
+        r'(?:^[A-Za-z0-9][A-Za-z0-9_:]*[A-Za-z0-9]$|^[A-Za-z0-9]$)')
 
     def __init__(self, orig=None, name=None, desc=None):
         self.orig = orig
@@ -28,6 +60,8 @@ class Target():
         self.config = {}
         self.dockerfile = None
         self.container = None
+        self._cache_key = None
+        self._body_hash = None
 
         self.validate()
 
@@ -55,15 +89,14 @@ class Target():
 
     def validate(self):
         if self.name:
-            p = r'(?:^[A-Za-z0-9][A-Za-z0-9_:]*[A-Za-z0-9]$|^[A-Za-z0-9]$)'
-            if not re.match(p, self.name):
+            if not self.name_pattern.match(self.name):
                 raise RunfileFormatError(
                     f'Invalid target name "{self.name}". Target names may '
                     'only contain alphanumeric characters, underscores, and '
                     'colons. Trailing underscores or colons are not '
                     'permitted.')
 
-    def execute(self, silent=False):
+    def execute(self, silent=False, rundir=None):
         self.result = TargetResult(self.unique_name)
         self.result.target_start = time.time()
         if not self.name:
@@ -89,9 +122,11 @@ class Target():
             style = MsgType.CONTAINER if self.container else MsgType.WORKING
             msg(f'Running {self.unique_name}...', style)
 
+        # Every block in a container costs several Docker API round trips
+        blocks = batch_blocks(self.blocks) if self.container else self.blocks
         try:
-            for block in self.blocks:
-                block.execute(self.container)
+            for block in blocks:
+                block.execute(self.container, rundir)
             self.result.set_status(TargetResult.SUCCESS)
         except CodeBlockExecutionError as e:
             self.result.exception = e
@@ -100,64 +135,81 @@ class Target():
         if self.name and self.container != self.runfile.container():
             self.stop_container()
         if self.result.status == TargetResult.SUCCESS:
-            self.cache()['last_run'] = self.result.target_finish
-            self.cache()['body'] = self.body_hash()
-            if 'invalidates' in self.config:
-                for target_expr in self.config['invalidates']:
-                    for target in self.runfile.find_target(target_expr):
-                        target.clear_cache()
+            with cache_lock:
+                cache = self.cache()
+                cache['last_run'] = self.result.target_finish
+                cache['body'] = self.body_hash()
+                if 'invalidates' in self.config:
+                    # Composed configs often repeat an expression
+                    exprs = dict.fromkeys(self.config['invalidates'])
+                    targets = {target
+                               for expr in exprs
+                               for target in self.runfile.find_target(expr)}
+                    shared_cache()['targets'].discard(
+                        target.cache_key() for target in targets)
 
         return self.result
 
     def cache(self):
-        cache = RunfileCache()
-        return cache['targets'][self.cache_key()]
+        return shared_cache()['targets'][self.cache_key()]
+
+    def cached(self, field):
+        # For reads: cache() creates the target's entry if it is missing
+        entry = shared_cache().get('targets', {}).get(self.cache_key(), {})
+        return entry.get(field)
 
     def clear_cache(self):
-        cache = RunfileCache()
-        if self.cache_key() in cache['targets']:
-            del cache['targets'][self.cache_key()]
+        with cache_lock:
+            shared_cache()['targets'].discard([self.cache_key()])
 
+    # Targets are fully loaded before anything runs, so the key and body
+    # hash are computed on first use and kept for the rest of the run
     def cache_key(self):
-        h = hashlib.sha1()
-        header = self.runfile.header
-        h.update(self.runfile.path.encode('utf-8'))
-        for include in header.include_path:
-            h.update(include['path'].encode('utf-8'))
-        if self.name:
-            h.update(self.name.encode('utf-8'))
-        return h.hexdigest()[:7]
+        if self._cache_key is None:
+            parts = [self.runfile.path]
+            parts += [i['path'] for i in self.runfile.header.include_path]
+            if self.name:
+                parts.append(self.name)
+            data = ''.join(parts).encode('utf-8')
+            self._cache_key = fingerprint(data)[:7]
+        return self._cache_key
 
     def is_expired(self):
-        if not self.cache()['last_run']:
+        # Cheapest checks first; the body hash is only needed if nothing
+        # else has already expired the target
+        last_run = self.cached('last_run')
+        if not last_run:
             return True  # Need to run to have something to cache
-        if self.cache()['body'] != self.body_hash():
-            return True  # Code changed
 
-        for subtarget_expr in self.config.get('requires', []):
+        expires = human_time_to_seconds(self.config.get('expires', '0'))
+        if expires is not None and expires >= 0:
+            if last_run + expires < time.time():
+                return True  # Cache timed out
+
+        for subtarget_expr in dict.fromkeys(self.config.get('requires', [])):
             subtargets = self.runfile.find_target(subtarget_expr)
             for subtarget in subtargets:
-                if subtarget.cache()['last_run'] > self.cache()['last_run']:
+                subtarget_last_run = subtarget.cached('last_run')
+                if subtarget_last_run and subtarget_last_run > last_run:
                     return True
 
-        expires = human_time_to_seconds(self.config.get('expires', '0'))
-        if expires is None or expires < 0:
-            return False  # Cache indefinitely
-
-        return self.cache()['last_run'] + expires < time.time()
+        return self.cached('body') != self.body_hash()  # Code changed
 
     def body_hash(self):
-        h = hashlib.sha1()
-        for block in self.blocks:
-            h.update(block.body.encode('utf-8'))
-        return h.hexdigest()
+        if self._body_hash is None:
+            data = ''.join(block.body for block in self.blocks).encode('utf-8')
+            self._body_hash = fingerprint(data)
+        return self._body_hash
 
     def build_container(self):
-        client = docker.from_env()
-        df_hash = hashlib.sha1(self.dockerfile.encode('utf-8')).hexdigest()
-        if self.cache()['image'] and self.cache()['build_file'] == df_hash:
+        import docker
+        client = docker_client()
+        df_hash = fingerprint(
+            normalize_dockerfile(self.dockerfile).encode('utf-8'))
+        last_image = self.cached('image')
+        if last_image and self.cached('build_file') == df_hash:
             try:
-                image = client.images.get(self.cache()['image'])
+                image = client.images.get(last_image)
                 return self.start_container(image)
             except docker.errors.ImageNotFound:
                 pass
@@ -169,13 +221,13 @@ class Target():
         try:
             image = client.images.build(
                 fileobj=build_file,
-                rm=True
+                rm=True,
+                pull=False
             )[0]
         except docker.errors.BuildError as e:
             build_error = e
             print(str(build_error))
-            print(
-                f'Failed building container for {self.unique_name}.',
+            msg(f'Failed building container for {self.unique_name}.',
                 MsgType.FAILURE)
             print()
 
@@ -184,14 +236,16 @@ class Target():
 
         msg('Container built.', MsgType.CONTAINER)
         print()
-        self.cache()['image'] = image.id
-        self.cache()['build_file'] = df_hash
+        with cache_lock:
+            cache = self.cache()
+            cache['image'] = image.id
+            cache['build_file'] = df_hash
         self.start_container(image)
 
     # TODO: Get other volumes from target config, if applicable
     # TODO: Inspect image for workdir and default to /work
     def start_container(self, image):
-        client = docker.from_env()
+        client = docker_client()
         self.container = client.containers.run(
             image,
             command='/bin/cat',
@@ -215,7 +269,15 @@ class Target():
         )
 
     def stop_container(self):
-        self.container.exec_run(f'chown -R {os.getuid()}:{os.getgid()} /work')
+        uid, gid = HOST_UID, HOST_GID
+        # Only rewrite ownership of files the container left with another
+        # owner; fall back to chowning everything if find can't do it.
+        # -h re-owns symlinks themselves, never what they point at
+        exit_code, _ = self.container.exec_run(
+            f'find /work ( ! -user {uid} -o ! -group {gid} ) '
+            f'-exec chown -h {uid}:{gid} {{}} +')
+        if exit_code:
+            self.container.exec_run(f'chown -R {uid}:{gid} /work')
         self.container.kill()
 
 
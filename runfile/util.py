@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
-import humanize
 import os
 import re
+import threading
 import time
 from colorama import Fore, Style
-from datetime import timedelta
+from functools import lru_cache
+
+
+# Held while writing to stdout so concurrently running targets don't interleave
+output_lock = threading.RLock()
 
 
 def msg(message, kind=None, suffix=None):
@@ -25,59 +29,84 @@ def msg(message, kind=None, suffix=None):
     if suffix:
         out += f' {suffix}'
 
-    print(out)
+    with output_lock:
+        print(out)
 
 
-def humanize_abbreviated(s):
-    abbreviations = {
-        r' milliseconds?': 'ms',
-        r' seconds?': 's',
-        r' minutes?': 'm',
-        r' hours?': 'h',
-        r' days?': 'd'
-    }
-    for search, replace in abbreviations.items():
-        s = re.sub(search, replace, s)
-    return s
+@lru_cache(maxsize=None)
+def docker_client():
+    # docker-py is slow to import and only needed when running containers.
+    # Connecting negotiates the API version with the daemon; do it once
+    import docker
+    return docker.from_env()
+
+
+TIME_UNITS = {
+    'm': 60,
+    'h': 60 * 60,
+    'd': 60 * 60 * 24,
+    'w': 60 * 60 * 24 * 7,
+    's': 1,
+    '': 1
+}
+TIME_PATTERN = re.compile(r'(-?[0-9]+)([mhdws]?)')
+
+
+DURATION_UNITS = [
+    ('d', 60 * 60 * 24),
+    ('h', 60 * 60),
+    ('m', 60)
+]
 
 
 def duration(time1, time2=None):
     if not time2:
         time2 = time.time()
-    seconds = time2 - time1
-    delta = timedelta(seconds=seconds)
-    humanized = humanize.precisedelta(delta, minimum_unit='seconds')
-    return humanize_abbreviated(humanized)
+    seconds = round(time2 - time1, 2)
+    parts = []
+    for unit, size in DURATION_UNITS:
+        amount, seconds = divmod(seconds, size)
+        if amount:
+            parts.append(f'{int(amount)}{unit}')
+    seconds = round(seconds, 2)
+    if seconds or not parts:
+        if seconds == int(seconds):
+            parts.append(f'{int(seconds)}s')
+        else:
+            parts.append(f'{seconds:.2f}s')
+    if len(parts) == 1:
+        return parts[0]
+    return ', '.join(parts[:-1]) + ' and ' + parts[-1]
 
 
 def human_time_to_seconds(s):
     if s is None:
         return None
     seconds = 0
-    patterns = {
-        r'(-?[0-9]+)m': 60,
-        r'(-?[0-9]+)h': 60 * 60,
-        r'(-?[0-9]+)d': 60 * 60 * 24,
-        r'(-?[0-9]+)w': 60 * 60 * 24 * 7,
-        r'(-?[0-9]+)s?': 1
-    }
-    for pattern, factor in patterns.items():
-        match = re.search(pattern, s)
-        if match:
-            s = re.sub(pattern, '', s)
-            seconds += int(match.group(1)) * factor
+    # YAML hands over bare numbers like `expires: -1` as ints
+    for amount, unit in TIME_PATTERN.findall(str(s)):
+        seconds += int(amount) * TIME_UNITS[unit]
     return seconds
 
 
+NEWLINES = re.compile(r'\n+')
+SPACES = re.compile(r' +')
+EMPHASIS = [(char, re.compile(f'\\{char}(.+?)\\{char}')) for char in '_*`']
+
+
 def to_plaintext(text):
     if not text:
         return None
 
-    text = re.sub(r'\n+', " ", text)
-    text = re.sub(r' +', " ", text)
-    for char in list('_*`'):
-        regex = re.compile(f'\\{char}(.+?)\\{char}')
-        text = re.sub(regex, r'\1', text)
+    # Most descriptions are a single line of plain text; only run the
+    # substitutions that could change something
+    if '\n' in text:
+        text = NEWLINES.sub(" ", text)
+    if '  ' in text:
+        text = SPACES.sub(" ", text)
+    for char, regex in EMPHASIS:
+        if char in text:
+            text = regex.sub(r'\1', text)
 
     return text
 
@@ -107,6 +136,10 @@ class MsgType():
         'icon': '❌',
         'style': Fore.RED
     }
+    WARNING = {
+        'icon': '⚠️',
+        'style': Fore.YELLOW
+    }
     NEUTRAL = {
         'icon': None,
         'style': Style.DIM
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
-from runfile.cache import RunfileCache
+from runfile.cache import lock, RunfileCache
 
 
 def get():
@@ -22,8 +22,9 @@ def set():
         print("Usage: run_set <key> <value>", file=sys.stderr)
         sys.exit(2)
 
-    cache = RunfileCache()
-    cache['vars'][sys.argv[1]] = ' '.join(sys.argv[2:])
+    with lock:
+        cache = RunfileCache()
+        cache['vars'][sys.argv[1]] = ' '.join(sys.argv[2:])
 
 
 def delete():
@@ -31,11 +32,12 @@ def delete():
         print("Usage: run_del <key1> [key2] [key3]...", file=sys.stderr)
         sys.exit(2)
 
-    cache = RunfileCache()
     count = 0
-    for key in sys.argv[1:]:
-        if cache['vars'][key]:
-            del cache['vars'][key]
-            count += 1
+    with lock:
+        cache = RunfileCache()
+        for key in sys.argv[1:]:
+            if cache['vars'][key]:
+                del cache['vars'][key]
+                count += 1
 
     print(count, end='')
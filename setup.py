@@ -11,11 +11,6 @@ with open('requirements.txt') as requirements_file:
 with open('dev_requirements.txt') as dev_requirements_file:
     dev_requirements = dev_requirements_file.readlines()
 
-try:
-    import graphlib  # noqa: F401
-except ImportError:
-    requirements.append('graphlib_backport')
-
 setup(
     name='runfile',
     author='awk',
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import fcntl
+import pytest
+from runfile import cache
+from runfile.cache import RunfileCache, shared_cache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, 'shared', None)
+
+
+def test_discard(mocker):
+    rc = RunfileCache()
+    rc['targets']['a'] = 1
+    rc['targets']['b'] = 2
+    sync = mocker.spy(RunfileCache, 'sync')
+
+    rc['targets'].discard(['a', 'b', 'c'])
+
+    assert list(rc['targets']) == []
+    assert sync.call_count == 2  # Child delegates to its container
+
+
+def test_discard_nothing(mocker):
+    rc = RunfileCache()
+    sync = mocker.spy(RunfileCache, 'sync')
+
+    rc['targets'].discard(['a'])
+
+    sync.assert_not_called()
+
+
+def test_shared_cache_reused():
+    shared_cache()['vars']['foo'] = 'bar'
+
+    assert shared_cache() is shared_cache()
+
+
+def test_shared_cache_reloads_external_changes():
+    rc = shared_cache()
+    other = RunfileCache()
+    other['vars']['foo'] = 'baz'
+
+    assert shared_cache() is not rc
+    assert shared_cache()['vars']['foo'] == 'baz'
+
+
+def test_new_cache_keeps_targets():
+    rc = RunfileCache()
+    rc['targets']['a']['last_run'] = 100
+
+    assert RunfileCache()['targets']['a']['last_run'] == 100
+
+
+def test_get_does_not_create():
+    rc = RunfileCache()
+    rc['vars']['foo'] = 'bar'
+
+    assert rc.get('targets') is None
+    assert rc['vars'].get('missing') is None
+    assert set(RunfileCache()) == {'vars', 'version'}
+    assert list(RunfileCache()['vars']) == ['foo']
+
+
+def test_lock_excludes_other_processes():
+    def try_lock():
+        with open(cache.LOCK_FILE, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return True
+
+    with cache.lock:
+        with cache.lock:
+            assert not try_lock()
+        assert not try_lock()  # Still held by the outer block
+
+    assert try_lock()
+
+
+def test_load_stats_once(mocker):
+    rc = RunfileCache()
+    for name in ['a', 'b', 'c']:
+        rc['targets'][name]['last_run'] = 100
+    stat = mocker.patch('os.stat', wraps=cache.os.stat)
+
+    RunfileCache()
+
+    stat.assert_called_once_with(cache.CACHE_FILE)
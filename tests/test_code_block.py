@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+from runfile.code_block import CodeBlock, batch_blocks
+
+
+def test_batch_blocks():
+    blocks = [
+        CodeBlock('', 'sh', 'echo one'),
+        CodeBlock('', 'sh', 'echo two'),
+        CodeBlock('', 'python', 'print("three")'),
+        CodeBlock('', 'sh', 'echo four')
+    ]
+
+    ret = batch_blocks(blocks)
+
+    assert ret == [
+        CodeBlock('', 'sh', '(\necho one\n)\n(\necho two\n)'),
+        blocks[2],
+        blocks[3]
+    ]
+
+
+def test_batch_blocks_other_languages():
+    blocks = [
+        CodeBlock('', 'python', 'print("one")'),
+        CodeBlock('', 'python', 'print("two")')
+    ]
+
+    assert batch_blocks(blocks) == blocks
+
+
+def test_language_interned():
+    first = CodeBlock('', ''.join(['s', 'h']), 'echo 1')
+    second = CodeBlock('', ''.join(['s', 'h']), 'echo 2')
+
+    assert first.language is second.language
@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import pytest
-import yaml
 from collections import OrderedDict
-from runfile import Runfile, RunfileHeader
+from runfile import Runfile, RunfileHeader, _YamlLoader, cache, \
+    topological_sort
 from runfile.code_block import CodeBlock
-from runfile.exceptions import RunfileNotFoundError, RunfileFormatError
-from runfile.target import Target
+from runfile.exceptions import RunfileNotFoundError, RunfileFormatError, \
+    TargetExecutionError
+from runfile.target import Target, TargetResult
 from runfile.util import Error
 from textwrap import dedent
 
@@ -179,6 +181,8 @@ runfile_examples = {
         ]
     },
 }
+for example in runfile_examples.values():
+    example['content'] = dedent(example['content'])
 
 
 def test_read_file(mocker):
@@ -234,13 +238,46 @@ def test_content_local_file(mocker):
     rf_read.assert_called_once_with()
 
 
+def test_content_provider(mocker):
+    fetch = mocker.patch.object(Runfile, 'fetch_content')
+    rf = Runfile('MyRunfile.md', content_provider=lambda: '# Provided\n')
+
+    assert rf.content() == '# Provided\n'
+    fetch.assert_not_called()
+
+
+def test_content_cached(mocker):
+    rf = Runfile('MyRunfile.md')
+    rf_read = mocker.patch.object(Runfile, 'read_file')
+    mocker.patch('os.path.exists', return_value=True)
+
+    first = rf.content()
+    second = rf.content()
+
+    assert first is second
+    rf_read.assert_called_once_with()
+
+
+def test_content_after_write(mocker):
+    rf = Runfile('MyRunfile.md')
+    rf_read = mocker.patch.object(Runfile, 'read_file', return_value='old')
+    mocker.patch('os.path.exists', return_value=True)
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    assert rf.content() == 'old'
+    rf.write_file('new')
+
+    assert rf.content() == 'new'
+    rf_read.assert_called_once_with()
+
+
 def test_content_remote_file(mocker):
     rf = Runfile('https://example.com/MyRunfile.md')
     rf_read = mocker.patch.object(Runfile, 'read_file')
     file_exists = mocker.patch('os.path.exists', return_value=False)
     rq_response = mocker.MagicMock()
     rq_response.status_code = 200
-    rq_get = mocker.patch('requests.get', return_value=rq_response)
+    rq_get = mocker.patch('runfile.session.get', return_value=rq_response)
 
     ret = rf.content()
 
@@ -269,7 +306,7 @@ def test_content_remote_file_not_found(mocker):
     file_exists = mocker.patch('os.path.exists', return_value=False)
     rq_response = mocker.MagicMock()
     rq_response.status_code = 404
-    rq_get = mocker.patch('requests.get', return_value=rq_response)
+    rq_get = mocker.patch('runfile.session.get', return_value=rq_response)
 
     with pytest.raises(RunfileNotFoundError) as excinfo:
         rf.content()
@@ -307,14 +344,23 @@ def test_hash(mocker):
     assert ret == rf.header.__hash__.return_value
 
 
+def test_header_hash_after_prepend():
+    header = RunfileHeader(None, None, None, '[child](child.md)')
+    before = hash(header)
+
+    header.prepend_include({'name': 'parent', 'path': 'parent.md'})
+
+    assert hash(header) != before
+    assert hash(header) == hash('parent.md|child.md')
+
+
 @pytest.mark.parametrize("key", runfile_examples.keys())
 def test_tokenize(mocker, key):
-    rf_content = mocker.patch.object(Runfile, 'content')
-    rf_content.return_value = dedent(runfile_examples[key]['content'])
-    rf_ensure_includes = mocker.patch.object(Runfile, 'ensure_includes')
-    rf_name_targets = mocker.patch.object(Runfile, 'name_targets')
+    content = runfile_examples[key]['content']
+    rf = Runfile('some_file.md', content_provider=lambda: content)
+    rf_ensure_includes = mocker.patch.object(rf, 'ensure_includes')
+    rf_name_targets = mocker.patch.object(rf, 'name_targets')
 
-    rf = Runfile('some_file.md')
     rf.tokenize()
 
     tokens_only = [t for t in rf.tokens if not isinstance(t, str)]
@@ -329,9 +375,21 @@ def test_tokenize(mocker, key):
     rf_name_targets.assert_called_once_with()
 
 
-def test_tokenize_double_header(mocker):
-    rf_content = mocker.patch.object(Runfile, 'content')
-    rf_content.return_value = dedent("""\
+def test_tokenize_child_path(mocker):
+    content = runfile_examples['with_child']['content']
+    rf = Runfile('some_file.md', content_provider=lambda: content)
+    mocker.patch.object(rf, 'ensure_includes')
+    mocker.patch.object(rf, 'name_targets')
+
+    rf.tokenize()
+
+    child = rf.children['child']
+    assert child.path == 'https://example.com'
+    assert child.header == runfile_examples['with_child']['child_tokenized'][0]
+
+
+def test_tokenize_double_header():
+    content = dedent("""\
     # Some Runfile Header
 
     A runfile with two heads!
@@ -341,20 +399,19 @@ def test_tokenize_double_header(mocker):
     This is illegal you know.
     """)
 
-    rf = Runfile('some_file.md')
+    rf = Runfile('some_file.md', content_provider=lambda: content)
     with pytest.raises(RunfileFormatError) as excinfo:
         rf.tokenize()
 
     assert str(excinfo.value) == Error.DUPLICATE_HEADER
 
 
-def test_tokenize_missing_header(mocker):
-    rf_content = mocker.patch.object(Runfile, 'content')
-    rf_content.return_value = dedent("""\
+def test_tokenize_missing_header():
+    content = dedent("""\
     ## target_definition_before_header
     """)
 
-    rf = Runfile('some_file.md')
+    rf = Runfile('some_file.md', content_provider=lambda: content)
     with pytest.raises(RunfileFormatError) as excinfo:
         rf.tokenize()
 
@@ -391,7 +448,7 @@ def test_parse_special_blocks(mocker):
     assert rf.targets['Target_1'].config == yaml_load.return_value
     assert rf.targets['Target_1'].dockerfile == 'dockerfile definition'
     assert rf.targets['Target_1'].blocks == [sh_block]
-    yaml_load.assert_called_once_with('yaml config', Loader=yaml.SafeLoader)
+    yaml_load.assert_called_once_with('yaml config', Loader=_YamlLoader)
 
 
 def test_loading_includes(mocker):
@@ -430,6 +487,17 @@ def test_include_too_many_maps(mocker):
     assert str(excinfo.value) == Error.INCLUDE_MULTIPLE_KEYS
 
 
+def test_include_empty_map(mocker):
+    rf = Runfile('some_file.md')
+    rf.targets = {None: Target(None)}
+    rf.targets[None].config = {'includes': [{}]}
+
+    with pytest.raises(RunfileFormatError) as excinfo:
+        rf.includes()
+
+    assert str(excinfo.value) == Error.INCLUDE_MULTIPLE_KEYS
+
+
 def test_include_duplicate_key(mocker):
     rf = Runfile('some_file.md')
     rf.targets = {None: Target(None)}
@@ -481,3 +549,195 @@ def test_ensure_includes(mocker):
     ]
     assert rf.children['include_2'].path == 'https://example.com/Include2.md'
     assert rf.children['include_4'] == orig_children['include_4']
+
+
+included_runfile = dedent("""\
+    # Root
+
+    ```yaml
+    includes:
+      - child: https://example.com/Child.md
+    ```
+
+    # Child
+
+    > Included from [child](https://example.com/Child.md)
+
+    ## old_target
+    """)
+
+
+@pytest.mark.parametrize("changed", [False, True])
+def test_update(mocker, changed):
+    rf = Runfile('some_file.md', content_provider=lambda: included_runfile)
+    rf.load()
+    child = rf.children['child']
+    fetch = mocker.patch.object(
+        Runfile, 'fetch_if_changed',
+        return_value='# Child\n\n## new_target\n' if changed else None)
+
+    rf.update()
+
+    fetch.assert_called_once_with(known=True)
+    if changed:
+        assert rf.children['child'] is not child
+        assert list(rf.children['child'].targets) == [None, 'new_target']
+        assert rf.children['child'].header.include_path == [
+            {'name': 'child', 'path': 'https://example.com/Child.md'}]
+    else:
+        assert rf.children['child'] is child
+
+
+def test_fetch_if_changed(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, 'shared', None)
+    fetched = mocker.MagicMock(status_code=200, text='# Remote\n',
+                               headers={'ETag': '"abc"'})
+    unchanged = mocker.MagicMock(status_code=304, headers={})
+    rq_get = mocker.patch('runfile.session.get',
+                          side_effect=[fetched, unchanged, fetched])
+    rf = Runfile('https://example.com/MyRunfile.md')
+
+    assert rf.fetch_if_changed(known=True) == '# Remote\n'
+    assert rf.fetch_if_changed(known=True) is None  # 304
+    assert rf.fetch_if_changed(known=True) is None  # Same content
+    rq_get.assert_called_with('https://example.com/MyRunfile.md',
+                              headers={'If-None-Match': '"abc"'})
+
+
+def test_topological_sort():
+    graph = {
+        'c': {'a', 'b'},
+        'b': {'a'},
+        'd': set()
+    }
+
+    order, loops = topological_sort(graph)
+
+    assert order.index('a') < order.index('b') < order.index('c')
+    assert sorted(order) == ['a', 'b', 'c', 'd']
+    assert loops == []
+
+
+def test_topological_sort_loop():
+    graph = {
+        'a': {'b'},
+        'b': {'c'},
+        'c': {'a'}
+    }
+
+    order, loops = topological_sort(graph)
+
+    assert order == ['c', 'b', 'a']
+    assert loops == [['a', 'b', 'c', 'a']]
+
+
+chain_runfile = dedent("""\
+    # Chain
+
+    ```sh
+    echo global
+    ```
+
+    ## a
+
+    ```yaml
+    requires:
+      - b
+      - c
+      - d
+      - e
+    ```
+
+    ## b
+
+    ```yaml
+    requires:
+      - c
+    ```
+
+    ## c
+
+    ## d
+
+    ## e
+    """)
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_execute_target_global_first(mocker, jobs):
+    ran = []
+
+    def execute(target, silent=False, rundir=None):
+        ran.append(target.name)
+        result = TargetResult(target.name)
+        result.target_start = 0
+        result.set_status(TargetResult.SUCCESS)
+        return result
+
+    mocker.patch.object(Target, 'execute', autospec=True, side_effect=execute)
+    rf = Runfile('some_file.md', content_provider=lambda: chain_runfile)
+    rf.load()
+    rf.jobs = jobs
+
+    rf.execute_target('a')
+
+    assert ran[0] is None
+    assert sorted(ran[1:]) == ['a', 'b', 'c', 'd', 'e']
+    assert ran.index('c') < ran.index('b') < ran.index('a')
+
+
+failing_runfile = dedent("""\
+    # Failing
+
+    ## fail
+
+    ## ok
+
+    ## after_ok
+
+    ```yaml
+    requires:
+      - ok
+    ```
+
+    ## top
+
+    ```yaml
+    requires:
+      - fail
+      - after_ok
+    ```
+    """)
+
+
+def test_execute_concurrently_stops_after_failure(mocker):
+    ran = []
+
+    def execute(target, silent=False, rundir=None):
+        ran.append(target.name)
+        result = TargetResult(target.name)
+        result.target_start = 0
+        if target.name == 'fail':
+            result.exception = TargetExecutionError(1)
+            result.set_status(TargetResult.FAILURE)
+        else:
+            result.set_status(TargetResult.SUCCESS)
+        return result
+
+    def wait(futures, return_when=None):
+        # Hand back fail and ok together, with the success handled first
+        done, _ = concurrent.futures.wait(futures)
+        return sorted(done, key=lambda f: f.result().status), set()
+
+    mocker.patch.object(Target, 'execute', autospec=True, side_effect=execute)
+    mocker.patch('runfile.wait', side_effect=wait)
+    rf = Runfile('some_file.md', content_provider=lambda: failing_runfile)
+    rf.load()
+    rf.jobs = 4
+
+    with pytest.raises(TargetExecutionError):
+        rf.execute_target('top')
+
+    assert ran[0] is None
+    assert sorted(ran[1:]) == ['fail', 'ok']
@@ -2,7 +2,7 @@
 
 import pytest
 from runfile.exceptions import RunfileFormatError
-from runfile.target import Target
+from runfile.target import Target, normalize_dockerfile
 
 
 @pytest.mark.parametrize("name,valid", [
@@ -22,3 +22,54 @@ def test_validate(name, valid):
     else:
         with pytest.raises(RunfileFormatError):
             Target(name=name)
+
+
+@pytest.mark.parametrize("in_,out", [
+    ["FROM alpine\nRUN true", "FROM alpine\nRUN true"],
+    ["FROM alpine  \n\n# A comment\n  # Indented\nRUN true\n",
+     "FROM alpine\nRUN true"],
+    ["# syntax=docker/dockerfile:1\nFROM alpine",
+     "# syntax=docker/dockerfile:1\nFROM alpine"],
+    ["FROM alpine\nRUN <<EOF\n# kept\nEOF\n",
+     "FROM alpine\nRUN <<EOF\n# kept\nEOF\n"]
+])
+def test_normalize_dockerfile(in_, out):
+    assert normalize_dockerfile(in_) == out
+
+
+@pytest.mark.parametrize("last_run,body,expires,sub_last_run,expired", [
+    [None, 'hash', '-1', None, True],
+    [100, 'hash', '-1', None, False],
+    [100, 'old', '-1', None, True],
+    [100, 'hash', '10s', None, True],
+    [100, 'hash', None, 200, True],
+    [100, 'hash', None, 50, False],
+    [100, 'hash', -1, None, False]
+])
+def test_is_expired(mocker, last_run, body, expires, sub_last_run, expired):
+    mocker.patch('time.time', return_value=1000)
+    subtarget = Target(name='sub')
+    mocker.patch.object(subtarget, 'cached',
+                        side_effect={'last_run': sub_last_run}.get)
+    target = Target(name='foo')
+    target.config = {'expires': expires, 'requires': ['sub']}
+    target.runfile = mocker.MagicMock()
+    target.runfile.find_target.return_value = [subtarget]
+    mocker.patch.object(target, 'cached',
+                        side_effect={'last_run': last_run, 'body': body}.get)
+    mocker.patch.object(target, 'body_hash', return_value='hash')
+
+    assert target.is_expired() == expired
+
+
+def test_is_expired_duplicate_requires(mocker):
+    target = Target(name='foo')
+    target.config = {'expires': '-1', 'requires': ['sub', 'sub']}
+    target.runfile = mocker.MagicMock()
+    target.runfile.find_target.return_value = []
+    mocker.patch.object(target, 'cached',
+                        side_effect={'last_run': 100, 'body': 'hash'}.get)
+    mocker.patch.object(target, 'body_hash', return_value='hash')
+
+    assert not target.is_expired()
+    target.runfile.find_target.assert_called_once_with('sub')
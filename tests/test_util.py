@@ -2,7 +2,7 @@
 
 import pytest
 
-from runfile.util import to_plaintext
+from runfile.util import duration, human_time_to_seconds, to_plaintext
 
 
 @pytest.mark.parametrize(
@@ -11,6 +11,8 @@ from runfile.util import to_plaintext
         ["A *bold* assumption.", "A bold assumption."],
         ["Hello\n\n\n world!", "Hello world!"],
         ["A `grave error.", "A `grave error."],
+        ["Nothing to strip.", "Nothing to strip."],
+        ["Run `make` and *then*\ndeploy.", "Run make and then deploy."],
         [
             "A  _ridiculous_ amount of emphasis;   simply _ridiculous_.",
             "A ridiculous amount of emphasis; simply ridiculous."
@@ -19,3 +21,38 @@ from runfile.util import to_plaintext
 )
 def test_to_plaintext(in_, out):
     assert to_plaintext(in_) == out
+
+
+@pytest.mark.parametrize(
+    ["in_", "out"],
+    [
+        [None, None],
+        ["0", 0],
+        ["90", 90],
+        ["10s", 10],
+        ["1h30m", 5400],
+        ["1d2h", 93600],
+        ["2w", 1209600],
+        ["-1", -1],
+        [-1, -1]
+    ]
+)
+def test_human_time_to_seconds(in_, out):
+    assert human_time_to_seconds(in_) == out
+
+
+@pytest.mark.parametrize(
+    ["seconds", "out"],
+    [
+        [0.004, "0s"],
+        [1.5, "1.50s"],
+        [59.999, "1m"],
+        [61.2, "1m and 1.20s"],
+        [3600, "1h"],
+        [3725.5, "1h, 2m and 5.50s"],
+        [90000, "1d and 1h"],
+        [200000.3, "2d, 7h, 33m and 20.30s"]
+    ]
+)
+def test_duration(seconds, out):
+    assert duration(1000, 1000 + seconds) == out